@@ -5,12 +5,101 @@ This code is an environment for use with the Street Sweeper World assignment.
 import osmnx as ox
 import networkx as nx
 import random
+import heapq
+import hashlib
+import os
+import pickle
+import tempfile
+from array import array
+import numpy as np
 from matplotlib import pyplot as plt
-import copy
+
+
+def _copy_attributes(data):
+    """ copies a node or street attribute dict so the bot can't edit the map
+
+        the values are scalars, immutable geometries, or (for streets that merge
+        several OSM ways) flat lists, so this is all a deepcopy would protect
+        and it is much cheaper
+    """
+    return {key: list(value) if isinstance(value, list) else value for key, value in data.items()}
+
+
+def _download_street_graph(place):
+    """ downloads the drivable street network for a place and adds speeds and
+        travel times to it
+    """
+    # Load the graph for a specific area
+    street_graph = ox.graph_from_place(place, network_type='drive')
+
+    # impute speed on all edges missing data, treat missing values as 40kph ~25mph
+    street_graph = ox.add_edge_speeds(street_graph,fallback=40)
+    # calculate travel time (seconds) for all edges
+    street_graph = ox.add_edge_travel_times(street_graph)
+
+    return street_graph
+
+
+def _load_street_graph(place, use_cache=True):
+    """ gets the street graph for a place from _download_street_graph, caching the
+        result on disk so that setting up the same place again (e.g. to try
+        another map_number) skips the download
+
+        with use_cache=False the cache is neither read nor written
+    """
+    if not use_cache:
+        return _download_street_graph(place)
+
+    # keep the cache in the user's own cache directory - we unpickle whatever is
+    # there, so it must not live somewhere other users can write to (like /tmp)
+    cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'mapbots')
+    cache_key = hashlib.md5(f"{place}|{ox.__version__}|{nx.__version__}".encode()).hexdigest()
+    cache_path = os.path.join(cache_dir, f"street_graph_{cache_key}.pkl")
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except Exception:
+            # a truncated file, or one that no longer unpickles after a library
+            # upgrade - throw it away and rebuild it below
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+
+    street_graph = _download_street_graph(place)
+
+    # write to a uniquely named temporary file first and then move it into place, so
+    # an interrupted run or two runs building the same place can't leave a broken cache
+    temp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as cache_file:
+            temp_path = cache_file.name
+            pickle.dump(street_graph, cache_file)
+        os.replace(temp_path, cache_path)
+    except (OSError, pickle.PicklingError):
+        # the cache is only a speedup, so carry on without it
+        pass
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return street_graph
+
 
 class StreetSweeperWorld:
+    """ a street map with randomly placed dirty regions and a bot that can move
+        around it cleaning streets
+
+        the downloaded map for each place is cached in ~/.cache/mapbots (or
+        $XDG_CACHE_HOME/mapbots) so it only has to be downloaded once - the cache
+        never expires and doesn't know about custom ox.settings, so pass
+        use_cache=False to always download a fresh map instead (delete that
+        folder to clear out old maps)
+    """
     
-    def __init__(self,place='Des Moines, Iowa, USA',map_number=None):
+    def __init__(self,place='Des Moines, Iowa, USA',map_number=None,use_cache=True):
         
         print("Setting up the map. This may take a few minutes.")
         
@@ -18,22 +107,24 @@ class StreetSweeperWorld:
         if map_number:
             random.seed(map_number)
             
-        # Load the graph for a specific area
-        self.__street_graph = ox.graph_from_place(place, network_type='drive')
+        # Load the graph for a specific area, with speeds and travel times
+        self.__street_graph = _load_street_graph(place, use_cache)
+        
+        # list the intersections once so we can pick random ones from it
+        self.__nodes_list = list(self.__street_graph.nodes())
         
-        # impute speed on all edges missing data, treat missing values as 40kph ~25mph
-        self.__street_graph = ox.add_edge_speeds(self.__street_graph,fallback=40)
-        # calculate travel time (seconds) for all edges
-        self.__street_graph = ox.add_edge_travel_times(self.__street_graph)
+        # flatten the street data into arrays for quick lookups as the bot moves
+        self.__initialize_street_arrays()
         
         # randomize dirty locations
         self.__initialize_dirt()
         
         # randomly choose a starting intersection for the bot
-        self.__bot_location = random.choice(list(self.__street_graph.nodes()))
+        self.__bot_location = random.choice(self.__nodes_list)
 
         # initialize the bot's route as just the starting location
-        self.__bot_route = [self.__bot_location]
+        # (OSM node ids are 64-bit ints, so we can pack them instead of keeping a list of int objects)
+        self.__bot_route = array('q', [self.__bot_location])
         
         # initialize battery life
         self.__battery_life = 72000 #an abstract number, equivalent to the number of seconds in 20 hours
@@ -49,33 +140,81 @@ class StreetSweeperWorld:
         num_edges = len(self.__street_graph.edges)
         #print("Number of nodes and edges:",num_nodes, num_edges)
         
-        # Initialize all streets as 'clean'
-        for u, v, key in self.__street_graph.edges(keys=True):
-            self.__street_graph[u][v][key]['cleanliness'] = 'clean'
-
         # Randomly determine the number of dirty regions
         # between a fifth and a half of 1 percent of intersections
         num_dirty_regions = random.randint(max(int(num_nodes*0.002),1), max(int(num_nodes*0.005),1))
 
-        # Create dirty regions
+        # Choose a random center node and a random radius
+        # between 1 and 2000 meters for each dirty region
+        regions = []
         for _ in range(num_dirty_regions):
-            # Choose a random node as the center of a dirty region
-            center_node = random.choice(list(self.__street_graph.nodes()))
-
-            # Random radius between 1 and 2000 meters
+            center_node = random.choice(self.__nodes_list)
             radius = random.randint(1, 2000)
+            regions.append((center_node, radius))
+
+        self.__mark_dirty_regions(regions)
 
+    def __mark_dirty_regions(self, regions):
+        """ for each region, marks every street whose endpoints are both within
+            that region's radius (in network distance) of its center as dirty
+
+            each region gets its own bounded Dijkstra search over the prebuilt
+            adjacency list, which is what ego_graph would find without having to
+            build and copy a subgraph for every region
+        """
+        for center_node, radius in regions:
             # Get all nodes within this radius (in network distance)
-            subgraph = nx.ego_graph(self.__street_graph, center_node, radius=radius, distance='length')
+            dist_to = {center_node: 0}
+            frontier = [(0, center_node)]
+            in_region = set()
+            while frontier:
+                dist, u = heapq.heappop(frontier)
+                if u in in_region:
+                    continue
+                in_region.add(u)
+
+                for v, length, _ in self.__street_adjacency[u]:
+                    next_dist = dist + length
+                    # nodes past the edge of the region are dropped instead of enqueued
+                    if next_dist <= radius and next_dist < dist_to.get(v, float('inf')):
+                        dist_to[v] = next_dist
+                        heapq.heappush(frontier, (next_dist, v))
 
             # Mark edges within this radius as 'dirty'
-            for u, v, key in subgraph.edges(keys=True):
-                if self.__street_graph.has_edge(u, v, key):
-                    self.__street_graph[u][v][key]['cleanliness'] = 'dirty'
+            for u in in_region:
+                for v, _, street in self.__street_adjacency[u]:
+                    if v in in_region:
+                        self.__street_is_clean[street] = False
                     
+    def __initialize_street_arrays(self):
+        """ stores the length, travel time, and cleanliness of every street in
+            parallel arrays, one row per street in the same order as the graph's edges,
+            along with a lookup from (start, end, key) to that street's row and a plain
+            adjacency list of (end, length, row) for each node to search the map with
+
+            cleanliness only lives in this array (it is not a graph attribute) and
+            every street starts out clean
+        """
+        self.__street_index = {}
+        self.__street_adjacency = {node: [] for node in self.__nodes_list}
+        lengths = []
+        travel_times = []
+        for i, (u, v, key, data) in enumerate(self.__street_graph.edges(keys=True, data=True)):
+            self.__street_index[(u, v, key)] = i
+            self.__street_adjacency[u].append((v, data['length'], i))
+            lengths.append(data['length'])
+            travel_times.append(data['travel_time'])
+
+        # lengths and travel times stay float64 - they are summed into the battery
+        # life and meters cleaned that the bot reports, where float32 rounding shows
+        self.__street_lengths = np.array(lengths, dtype=np.float64)
+        self.__street_travel_times = np.array(travel_times, dtype=np.float64)
+        self.__street_is_clean = np.ones(len(lengths), dtype=np.bool_)
+
     def display_map(self):
         # make dirty streets brown and clean streets white
-        ec = ['brown' if data['cleanliness'] == 'dirty' else 'white' for u, v, key, data in self.__street_graph.edges(keys=True, data=True)]
+        # (the street arrays are in the same order as the graph's edges)
+        ec = np.where(self.__street_is_clean, 'white', 'brown').tolist()
         # display the route itself in blue
         fig, ax = ox.plot_graph_route(self.__street_graph,self.__bot_route, route_color="blue", bgcolor="gray", edge_color=ec, node_size=0, show=False, close=False)
         
@@ -88,39 +227,45 @@ class StreetSweeperWorld:
         
         # loop over all edges/streets that have the current node
         # as a starting point, u an v are the node ids of the two endpoints of the edge
-        for u,v in self.__street_graph.out_edges(self.__bot_location):
-            # prepare info dict for the starting point
-            u_data = copy.deepcopy(self.__street_graph.nodes[u])
-            u_data["location_id"] = u
-            
-            # prepare info dict for the ending point
-            v_data = copy.deepcopy(self.__street_graph.nodes[v])
-            v_data["location_id"] = v
-            
-            # copy the street data - we don't want them to be able to edit this,
-            # so we make a copy
-            street_data = copy.deepcopy(self.__street_graph.get_edge_data(u,v)[0])
-            curr_street_info = {"start":u_data,"end":v_data,"street_data":street_data}
-            
-            next_streets_info.append(curr_street_info)
+        # (reading the adjacency dict directly is much faster than an out_edges view)
+        u = self.__bot_location
+        for v, keyed_streets in self.__street_graph.adj[u].items():
+            # parallel streets each get an entry, but moving along any of them
+            # uses the first one, so that's the one we describe
+            for _ in keyed_streets:
+                # prepare info dict for the starting point
+                u_data = _copy_attributes(self.__street_graph.nodes[u])
+                u_data["location_id"] = u
+                
+                # prepare info dict for the ending point
+                v_data = _copy_attributes(self.__street_graph.nodes[v])
+                v_data["location_id"] = v
+                
+                # copy the street data - we don't want them to be able to edit this,
+                # so we make a copy
+                street_data = _copy_attributes(keyed_streets[0])
+                street_data["cleanliness"] = "clean" if self.__street_is_clean[self.__street_index[(u, v, 0)]] else "dirty"
+                curr_street_info = {"start":u_data,"end":v_data,"street_data":street_data}
+                
+                next_streets_info.append(curr_street_info)
         return next_streets_info
     
     def move_to(self,other):
         
         # check if we can really move to that id
-        if self.__street_graph.has_edge(self.__bot_location, other):
-            
-            # grab info about this street
-            edge_info = self.__street_graph.get_edge_data(self.__bot_location, other)[0]
+        street = self.__street_index.get((self.__bot_location, other, 0))
+        if street is not None:
             
             # change the bot's location to the other end of the street
-            self.__bot_location = other
+            # (stored as the graph's own integer id, since other only has to equal it -
+            # e.g. a float - and the route can only hold ints)
+            self.__bot_location = int(other)
             
             # add the new location to the route
             self.__bot_route.append(self.__bot_location)
             
             # subtract the travel time from the bot's battery life
-            self.__battery_life -= edge_info["travel_time"]
+            self.__battery_life -= float(self.__street_travel_times[street])
             
             # return the id of the new location
             return self.__bot_location
@@ -131,18 +276,18 @@ class StreetSweeperWorld:
     def clean_and_move_to(self,other):
         
         # check if we can really move there
-        if self.__street_graph.has_edge(self.__bot_location, other):
+        street = self.__street_index.get((self.__bot_location, other, 0))
+        if street is not None:
             
             # cleaning costs 3 times what it takes to just move
             # so we subtract extra beyond what it takes to move
-            edge_info = self.__street_graph.get_edge_data(self.__bot_location, other)[0]
-            self.__battery_life -= 2*edge_info["travel_time"]
+            self.__battery_life -= 2*float(self.__street_travel_times[street])
             
             # if this street isn't clean, we make it clean and count it
             # towards the total length of streets that have been cleaned
-            if edge_info["cleanliness"] != "clean":
-                self.__meters_cleaned += edge_info["length"]
-                edge_info["cleanliness"] = "clean"
+            if not self.__street_is_clean[street]:
+                self.__meters_cleaned += float(self.__street_lengths[street])
+                self.__street_is_clean[street] = True
                 
             # use the other method to actually make the move
             return self.move_to(other)
@@ -154,8 +299,8 @@ class StreetSweeperWorld:
         """ this is necessary if the bot gets stuck with no outgoing streets
             if so, a free back up is allowed
         """
-        for _ in range(how_many):
-            self.__bot_route.pop() #remove the most recent node
+        # remove the most recent nodes all at once
+        del self.__bot_route[max(len(self.__bot_route) - how_many, 0):]
         self.__bot_location = self.__bot_route[-1] #reset the location to the previous node
             
     def get_battery_life(self):
@@ -165,6 +310,6 @@ class StreetSweeperWorld:
         return self.__meters_cleaned
     
     def get_current_location(self):
-        curr_loc = copy.deepcopy(self.__street_graph.nodes[self.__bot_location])
+        curr_loc = _copy_attributes(self.__street_graph.nodes[self.__bot_location])
         curr_loc["location_id"] = self.__bot_location
         return curr_loc
\ No newline at end of file